@@ -1,19 +1,29 @@
+import math
+
 import streamlit as st
 import numpy as np
 import plotly.graph_objects as go
 
+try:
+    import numexpr as ne
+except ImportError:  # optional: falls back to NumPy
+    ne = None
+
 # === Title ===
 battery_model = "YUASA NPW45-12"
 nominal_capacity_ah = 7.5
 st.title(f"Battery Capacity Retention Over Time — {battery_model}")
 
+# === Temperature Grid (bounds of the temperature sliders and the rate-factor table) ===
+TEMP_GRID_MIN, TEMP_GRID_MAX = -20, 60
+
 # === Sidebar Inputs ===
 initial_capacity = st.sidebar.slider("Initial Capacity (%)", 50, 100, 95)
 input_months = st.sidebar.number_input("Storage Time (Months)", 0, 120, 12)
 input_days = st.sidebar.number_input("Additional Days", 0, 31, 0)
 input_hours = st.sidebar.number_input("Additional Hours", 0, 23, 0)
-min_temp = st.sidebar.slider("Min Temperature (°C)", -20, 25, -15)
-max_temp = st.sidebar.slider("Max Temperature (°C)", 25, 60, 45)
+min_temp = st.sidebar.slider("Min Temperature (°C)", TEMP_GRID_MIN, 25, -15)
+max_temp = st.sidebar.slider("Max Temperature (°C)", 25, TEMP_GRID_MAX, 45)
 temp_step = st.sidebar.slider("Temperature Step (°C)", 1, 10, 5)
 
 # === Constants for model ===
@@ -21,74 +31,138 @@ base_temp = 25
 base_rate = 0.0342
 Q0 = initial_capacity
 total_months = input_months + (input_days / 30.42) + (input_hours / 24 / 30.42)
-x_months = np.arange(0, total_months + 0.1, 0.1)
-x_days = x_months * 30.42
-x_hours = x_days * 24
 temps = np.arange(min_temp, max_temp + 1, temp_step)
-temps_list = [int(t) for t in temps]
+temps_list = temps.astype(np.int64).tolist()
 
 # === Color Map ===
 color_palette = [
     "#636EFA", "#EF553B", "#00CC96", "#AB63FA",
     "#FFA15A", "#19D3F3", "#FF6692", "#B6E880"
 ]
-color_map = {t: color_palette[i % len(color_palette)] for i, t in enumerate(temps_list)}
-
-# === Create Capacity Plot ===
-fig = go.Figure()
-curves = {}
-for T in temps_list:
-    k_T = base_rate * 2 ** ((T - base_temp) / 10)
-    capacity = Q0 * ((1 - k_T) ** x_months)
-    final_capacity = capacity[-1]
-    curves[T] = capacity
-
-    fig.add_trace(go.Scatter(
-        x=x_months, y=capacity, mode='lines',
-        name=f"{T}°C — Final: {final_capacity:.1f}%",
-        line=dict(color=color_map[T]),
-        hovertemplate='Month: %{x:.2f}<br>Capacity: %{y:.2f}%<extra></extra>'
-    ))
 
-    fig.add_trace(go.Scatter(
-        x=[x_months[-1]], y=[final_capacity],
-        mode='markers', marker=dict(size=8, color=color_map[T]),
-        showlegend=False,
-        hovertemplate=(f"<b>Temp:</b> {T}°C<br>"
-                       f"<b>Month:</b> {x_months[-1]:.2f}<br>"
-                       f"<b>Hour:</b> {x_hours[-1]:.0f}<br>"
-                       f"<b>Cap:</b> {final_capacity:.2f}%<extra></extra>")
-    ))
+# === Rate Factor Lookup ===
+# Rate doubling 2**((T - base_temp)/10) for every integer °C on the grid, built once per process
+@st.cache_resource
+def temp_rate_factor_table(base_temp):
+    return 2.0 ** ((np.arange(TEMP_GRID_MIN, TEMP_GRID_MAX + 1) - base_temp) / 10.0)
+
+def temp_rate_factor(temps):
+    idx = np.asarray(temps) - TEMP_GRID_MIN
+    if idx.min() < 0 or idx.max() > TEMP_GRID_MAX - TEMP_GRID_MIN:
+        raise ValueError(f"Temperatures must lie within {TEMP_GRID_MIN}..{TEMP_GRID_MAX} °C")
+    return temp_rate_factor_table(base_temp)[idx]
+
+# === Capacity Curves (cached across reruns) ===
+NUMEXPR_MIN_SIZE = 10000  # below this, numexpr's thread/chunk setup costs more than it saves
+
+@st.cache_data
+def compute_curves(Q0, base_rate, total_months, temps_tuple):
+    # ~4 samples per month, 50-400 points: smooth decays need no finer grid
+    n = min(400, max(50, int(total_months * 4)))
+    x = np.linspace(0, total_months, n)
+    k = base_rate * temp_rate_factor(temps_tuple)
+    # (1 - k) ** x == exp(x * log1p(-k)); log1p stays accurate for small k
+    lnk = np.log1p(-k)
+    if ne is not None and lnk.size * x.size >= NUMEXPR_MIN_SIZE:
+        cap = ne.evaluate("Q0 * exp(lnk * x)",
+                          local_dict={"Q0": Q0, "lnk": lnk[:, None], "x": x[None, :]})
+    else:
+        cap = Q0 * np.exp(np.multiply.outer(lnk, x))  # (n_temps, n_samples)
+    # float32 keeps ~7 significant digits (display uses 2) and halves the payload sent to Plotly
+    cap = cap.astype(np.float32)
+    x = x.astype(np.float32)
+    return x, cap
 
 # === Highlight Area Between Temperatures ===
-def get_closest_index(array, value):
-    return int((np.abs(array - value)).argmin())
-
-highlight_start_idx = get_closest_index(temps, -5)
-highlight_end_idx = get_closest_index(temps, 35)
-highlight_start = st.sidebar.selectbox("Highlight Start Temp (°C)", temps_list, index=highlight_start_idx)
-highlight_end = st.sidebar.selectbox("Highlight End Temp (°C)", temps_list, index=highlight_end_idx)
-
-if highlight_start != highlight_end:
-    lower_T, upper_T = sorted((highlight_start, highlight_end))
-    y_lower = curves[lower_T]
-    y_upper = curves[upper_T]
-    fig.add_trace(go.Scatter(
-        x=np.concatenate([x_months, x_months[::-1]]),
-        y=np.concatenate([y_upper, y_lower[::-1]]),
-        fill='toself', fillcolor='rgba(255, 215, 0, 0.2)',
-        line=dict(color='rgba(255,255,255,0)'),
-        hoverinfo='skip', showlegend=False
+def get_closest_index(sorted_array, value):
+    # Binary search on the ascending temps grid; ties go to the lower entry, as argmin did
+    i = int(np.searchsorted(sorted_array, value))
+    if i == 0:
+        return 0
+    if i == len(sorted_array):
+        return len(sorted_array) - 1
+    return i if abs(sorted_array[i] - value) < abs(sorted_array[i - 1] - value) else i - 1
+
+def build_fill(x, y_lo, y_hi):
+    return np.concatenate([x, x[::-1]]), np.concatenate([y_hi, y_lo[::-1]])
+
+# === Capacity Plot (reruns on its own when the highlight temps change) ===
+# Hover text is templated client-side; end markers carry [temp, hour] as customdata
+LINE_HOVER = 'Month: %{x:.2f}<br>Capacity: %{y:.2f}%<extra></extra>'
+FINAL_MARKER_HOVER = ("<b>Temp:</b> %{customdata[0]}°C<br>"
+                      "<b>Month:</b> %{x:.2f}<br>"
+                      "<b>Hour:</b> %{customdata[1]:.0f}<br>"
+                      "<b>Cap:</b> %{y:.2f}%<extra></extra>")
+
+# Shared, never-mutated Figure per input set; bounded since keys include every highlight pair
+@st.cache_resource(max_entries=32)
+def capacity_figure(Q0, base_rate, total_months, temps_tuple, highlight):
+    # cap is a contiguous (n_temps, n_samples) array; row i holds the curve for temps_tuple[i]
+    x_months, cap = compute_curves(Q0, base_rate, total_months, temps_tuple)
+    temp_to_row = dict(zip(temps_tuple, range(len(temps_tuple))))
+    x_days = x_months * 30.42
+    x_hours = x_days * 24
+    color_map = {t: color_palette[i % len(color_palette)] for i, t in enumerate(temps_tuple)}
+
+    final_capacities = cap[:, -1].tolist()
+    names = [f"{T}°C — Final: {f:.1f}%" for T, f in zip(temps_tuple, final_capacities)]
+
+    traces = []
+    for row, (T, name, final_capacity) in enumerate(zip(temps_tuple, names, final_capacities)):
+        traces.append(dict(
+            type='scattergl',
+            x=x_months, y=cap[row], mode='lines',
+            name=name,
+            line=dict(color=color_map[T]),
+            hovertemplate=LINE_HOVER
+        ))
+
+        traces.append(dict(
+            type='scattergl',
+            x=[x_months[-1]], y=[final_capacity],
+            customdata=[[T, x_hours[-1]]],
+            mode='markers', marker=dict(size=8, color=color_map[T]),
+            showlegend=False,
+            hovertemplate=FINAL_MARKER_HOVER
+        ))
+
+    if highlight is not None:
+        lower_T, upper_T = highlight
+        fill_x, fill_y = build_fill(x_months, cap[temp_to_row[lower_T]], cap[temp_to_row[upper_T]])
+        traces.append(dict(
+            type='scattergl',
+            x=fill_x,
+            y=fill_y,
+            fill='toself', fillcolor='rgba(255, 215, 0, 0.2)',
+            line=dict(color='rgba(255,255,255,0)'),
+            hoverinfo='skip', showlegend=False
+        ))
+
+    fig = go.Figure(layout=dict(
+        title=f"{battery_model} — Capacity Retention vs. Time & Temperature",
+        xaxis_title="Storage Time (Months)",
+        yaxis_title="Remaining Capacity (%)",
+        hovermode='x unified',
+        height=600,
+        uirevision='static'
     ))
+    # A single add_traces call instead of 2N+1 add_trace calls, each rebuilding fig.data
+    fig.add_traces(traces)
+    return fig
+
+@st.fragment
+def capacity_section():
+    highlight_start_idx = get_closest_index(temps, -5)
+    highlight_end_idx = get_closest_index(temps, 35)
+    col_start, col_end = st.columns(2)
+    highlight_start = col_start.selectbox("Highlight Start Temp (°C)", temps_list, index=highlight_start_idx)
+    highlight_end = col_end.selectbox("Highlight End Temp (°C)", temps_list, index=highlight_end_idx)
+    highlight = tuple(sorted((highlight_start, highlight_end))) if highlight_start != highlight_end else None
 
-fig.update_layout(
-    title=f"{battery_model} — Capacity Retention vs. Time & Temperature",
-    xaxis_title="Storage Time (Months)",
-    yaxis_title="Remaining Capacity (%)",
-    hovermode='x unified',
-    height=600
-)
-st.plotly_chart(fig, use_container_width=True)
+    fig = capacity_figure(Q0, base_rate, total_months, tuple(temps_list), highlight)
+    st.plotly_chart(fig, use_container_width=True)
+
+capacity_section()
 
 # === Self-Discharge Estimation ===
 st.header("Estimated Self-Discharge Current")
@@ -105,19 +179,6 @@ st.markdown(f"""
 - 🔌 **Self-discharge current**: **{current_ma:.0f} mA**
 """)
 
-# === Inrush Current and Voltage Drop Estimation ===
-st.header("Inrush Current and Voltage Drop Estimation")
-nominal_voltage = st.sidebar.number_input("Nominal Battery Voltage (V)", 12, 600, 240)
-max_power_kw = st.sidebar.number_input("Maximum Load Power (kW)", 1.0, 50.0, 12.0)
-max_power_w = max_power_kw * 1000
-inrush_current = max_power_w / nominal_voltage
-
-st.markdown(f"""
-- ⚡ **Maximum load power**: {max_power_kw:.1f} kW  
-- 🔌 **Nominal voltage**: {nominal_voltage} V  
-- 🧮 **Estimated inrush current**: {inrush_current:.1f} A
-""")
-
 # === Internal Resistance Over Aging (converted to mΩ) ===
 time = np.arange(0, 11)  # Years
 R_25_mohm = np.array([1.0, 1.05, 1.1, 1.25, 1.5, 1.75, 2.0, 2.5, 3.0, 3.75, 4.5]) * 13.83  # mΩ
@@ -126,45 +187,86 @@ Ea = 5000  # J/mol
 R_const = 8.314  # J/mol-K
 T_ref = 25
 T_15 = 15
-R_15_mohm = R_25_mohm * np.exp((Ea / R_const) * ((1 / (T_15 + 273.15)) - (1 / (T_ref + 273.15))))
-
-# Clamp negative voltages
-voltage_drop_15 = (R_15_mohm / 1000) * inrush_current
-terminal_voltage_15 = nominal_voltage - voltage_drop_15
-terminal_voltage_15 = np.clip(terminal_voltage_15, 0, nominal_voltage)
-
-# === Plot Terminal Voltage ===
-fig_v = go.Figure()
-fig_v.add_trace(go.Scatter(
-    x=time,
-    y=terminal_voltage_15,
-    mode='lines+markers',
-    name="Terminal Voltage (15°C Aging)",
-    line=dict(color='red'),
-    hovertemplate='Year: %{x}<br>Voltage: %{y:.2f} V<extra></extra>'
-))
-fig_v.update_layout(
-    title="Terminal Voltage vs. Aging Time (15°C)",
-    xaxis_title="Time (Years)",
-    yaxis_title="Terminal Voltage (V)",
-    height=400
-)
-st.plotly_chart(fig_v, use_container_width=True)
-
-# === Optional: Show Resistance Trend ===
-fig_r = go.Figure()
-fig_r.add_trace(go.Scatter(
-    x=time,
-    y=R_15_mohm,
-    mode='lines+markers',
-    name="Internal Resistance @15°C",
-    line=dict(color='blue'),
-    hovertemplate='Year: %{x}<br>Resistance: %{y:.1f} mΩ<extra></extra>'
-))
-fig_r.update_layout(
-    title="Internal Resistance vs. Aging Time (15°C)",
-    xaxis_title="Time (Years)",
-    yaxis_title="Internal Resistance (mΩ)",
-    height=400
-)
-st.plotly_chart(fig_r, use_container_width=True)
+EA_OVER_R = Ea / R_const  # K
+INV_TREF = 1.0 / (T_ref + 273.15)  # 1/K
+
+# Keyed on integer °C, so only a handful of entries are ever live
+@st.cache_data(max_entries=64)
+def arrhenius_R(T_C, R_base_tuple):
+    factor = math.exp(EA_OVER_R * (1.0 / (T_C + 273.15) - INV_TREF))
+    return np.asarray(R_base_tuple) * factor
+
+@st.cache_data
+def compute_terminal_voltage(R_mohm, nominal_voltage, inrush_current):
+    # Clamp negative voltages; the drop is never negative, so V can't exceed nominal.
+    # Reuse the drop array for each step instead of allocating per operation.
+    vdrop = R_mohm * (inrush_current / 1000.0)
+    np.subtract(nominal_voltage, vdrop, out=vdrop)
+    np.maximum(vdrop, 0.0, out=vdrop)
+    return vdrop
+
+# === Figures kept in session state and refilled in place on each rerun ===
+def get_figure(key, **layout):
+    if key not in st.session_state:
+        st.session_state[key] = go.Figure()
+    fig = st.session_state[key]
+    fig.data = ()
+    fig.update_layout(uirevision='static', **layout)
+    return fig
+
+# === Inrush Current and Voltage Drop Estimation (reruns on its own when voltage/power change) ===
+@st.fragment
+def inrush_section():
+    st.header("Inrush Current and Voltage Drop Estimation")
+    col_v, col_p = st.columns(2)
+    nominal_voltage = col_v.number_input("Nominal Battery Voltage (V)", 12, 600, 240)
+    max_power_kw = col_p.number_input("Maximum Load Power (kW)", 1.0, 50.0, 12.0)
+    max_power_w = max_power_kw * 1000
+    inrush_current = max_power_w / nominal_voltage
+
+    st.markdown(f"""
+- ⚡ **Maximum load power**: {max_power_kw:.1f} kW  
+- 🔌 **Nominal voltage**: {nominal_voltage} V  
+- 🧮 **Estimated inrush current**: {inrush_current:.1f} A
+""")
+
+    R_15_mohm = arrhenius_R(T_15, tuple(R_25_mohm))
+    terminal_voltage_15 = compute_terminal_voltage(R_15_mohm, nominal_voltage, inrush_current)
+
+    # === Plot Terminal Voltage ===
+    fig_v = get_figure(
+        'fig_v',
+        title="Terminal Voltage vs. Aging Time (15°C)",
+        xaxis_title="Time (Years)",
+        yaxis_title="Terminal Voltage (V)",
+        height=400
+    )
+    fig_v.add_trace(go.Scatter(
+        x=time,
+        y=terminal_voltage_15,
+        mode='lines+markers',
+        name="Terminal Voltage (15°C Aging)",
+        line=dict(color='red'),
+        hovertemplate='Year: %{x}<br>Voltage: %{y:.2f} V<extra></extra>'
+    ))
+    st.plotly_chart(fig_v, use_container_width=True)
+
+    # === Optional: Show Resistance Trend ===
+    fig_r = get_figure(
+        'fig_r',
+        title="Internal Resistance vs. Aging Time (15°C)",
+        xaxis_title="Time (Years)",
+        yaxis_title="Internal Resistance (mΩ)",
+        height=400
+    )
+    fig_r.add_trace(go.Scatter(
+        x=time,
+        y=R_15_mohm,
+        mode='lines+markers',
+        name="Internal Resistance @15°C",
+        line=dict(color='blue'),
+        hovertemplate='Year: %{x}<br>Resistance: %{y:.1f} mΩ<extra></extra>'
+    ))
+    st.plotly_chart(fig_r, use_container_width=True)
+
+inrush_section()